@@ -1,143 +1,394 @@
 # -*- coding: utf-8 -*-
 import glob
 import os
+import sys
 import re
 import json
 import gzip
-from collections import defaultdict, Counter
+import multiprocessing
+import sqlite3
+import threading
+from collections import defaultdict, deque
+from array import array
+from functools import lru_cache, partial
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from json.encoder import encode_basestring_ascii
 import argparse
 
+try:
+    import orjson
+except ImportError:  # optional, only makes saving and loading models faster
+    orjson = None
+
+# Tokenizer patterns by file extension, compiled on first use by
+# _get_tokenizer. Keywords are matched by the identifier branch, listing them
+# as separate alternatives only adds backtracking (and split "assert" into
+# "as", "sert")
+_CS_PATTERN = r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}<>]|"[^"\n]*"|\'[^\'\n]*\'|@"[^"\n]*"'
+_JS_PATTERN = r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|"[^"\n]*"|\'[^\'\n]*\'|`[^`\n]*`'
+_PY_PATTERN = r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|"[^"\n]*"|\'[^\'\n]*\''
+_GENERAL_PATTERN = r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|"[^"\n]*"|\'[^\'\n]*\''
+
+_PATTERNS = {
+    '.cs': _CS_PATTERN,
+    '.js': _JS_PATTERN,
+    '.ts': _JS_PATTERN,
+    '.py': _PY_PATTERN
+}
+
+# Tokens that end a sequence, the n-gram context never spans across them
+_FLOW_ENDERS = frozenset({'return', 'break', 'continue', 'pass'})
+_LANG_ENDERS = {
+    '.cs': _FLOW_ENDERS | {';', '{', '}'},
+    '.js': _FLOW_ENDERS | {';', '{', '}'},
+    '.ts': _FLOW_ENDERS | {';', '{', '}'},
+    '.py': _FLOW_ENDERS | {':'}
+}
+_DEFAULT_ENDERS = _FLOW_ENDERS | {';'}
+
+_READ_BATCH_SIZE = 1 << 20  # characters per batch of lines read from a file
+_SKIP_DIRS = {'node_modules', '__pycache__', 'venv'}  # besides hidden ones
+_FLAT_MAX_SUCCESSORS = 32  # beyond this PackedCounts is smaller than a flat tuple
+_GZIP_LEVEL = 6  # several times faster than the default 9, output ~5% larger
+_SAVE_BATCH_SIZE = 4096  # contexts unpacked and encoded at a time when saving
+_COMPACT_THRESHOLD = 1 << 16  # contexts unpacked by merge_counts before it packs them again
+
+@lru_cache(maxsize=256)
+def _get_tokenizer(ext):
+    """Returns the compiled tokenizer regex for a file extension.
+
+    Cached here rather than relying on the re module cache, which other
+    re.compile calls in the process can evict"""
+    return re.compile(_PATTERNS.get(ext, _GENERAL_PATTERN))
+
+def _tokenize_code(content, ext):
+    """Language-specific code tokenization"""
+    # None of the patterns match whitespace or cross a newline, so the
+    # whole file is scanned in one pass with the same result as per line
+    return _get_tokenizer(ext).findall(content)
+
+def _context_key(context):
+    """Returns the model file key of a context tuple.
+
+    Keeps the json.dumps(list(context)) format the extension looks contexts
+    up by, but joins C-encoded tokens directly"""
+    return '[' + ', '.join(map(encode_basestring_ascii, context)) + ']'
+
+def count_file(filepath, n):
+    """Counts the n-grams of a single file.
+
+    Returns (ext, vocab, ngrams, total) where ngrams maps a context tuple to
+    {next_token: count}, or None if the file could not be processed. Has no
+    model state, so files can be counted in worker processes and merged into
+    the model with CodeNGramModel.merge_counts"""
+    try:
+        ext = os.path.splitext(filepath)[1].lower()
+        
+        # Tokens never span a newline, so the file is tokenized in batches
+        # of whole lines instead of being read into memory at once.
+        # Tokens are interned so equal ones share a single string object
+        # across all contexts and the vocabulary
+        tokens = []
+        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+            for lines in iter(lambda: f.readlines(_READ_BATCH_SIZE), []):
+                tokens.extend(map(sys.intern, _tokenize_code(''.join(lines), ext)))
+        
+        enders = _LANG_ENDERS.get(ext, _DEFAULT_ENDERS)
+        
+        # Sequences are split and counted in a single pass: the context
+        # window slides over the token stream and is cleared after every
+        # sequence ender, so no intermediate list of sequences is built
+        ngrams = {}
+        n1 = n - 1
+        total = 0
+        sequences = 0
+        window = deque(maxlen=n1)
+        for token in tokens:
+            if len(window) == n1:
+                context = tuple(window)
+                counts = ngrams.get(context)
+                if counts is None:
+                    counts = ngrams[context] = {}
+                counts[token] = counts.get(token, 0) + 1
+                total += 1
+            window.append(token)
+            
+            if token in enders:
+                window.clear()
+                sequences += 1
+        if window:
+            sequences += 1
+        
+        print(f"Processed {filepath}: {len(tokens)} tokens, {sequences} sequences")
+        return ext, set(tokens), ngrams, total
+        
+    except Exception as e:
+        print(f"Error processing {filepath}: {e}")
+        return None
+
+def find_files(root, extensions):
+    """Yields files under root ending with one of the extensions.
+
+    Hidden and dependency directories are pruned from the walk, so their
+    contents are never listed at all"""
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS and not d.startswith('.')]
+        for filename in filenames:
+            if filename.endswith(extensions) and not filename.startswith('.'):
+                yield os.path.join(dirpath, filename)
+
+class PackedCounts:
+    """Successor counts of a context packed by _pack_counts as a tuple of
+    tokens and a parallel array of 32-bit counts"""
+    __slots__ = ('tokens', 'counts')
+    
+    def __init__(self, tokens, counts):
+        self.counts = array('I', counts)
+        self.tokens = tuple(tokens)
+    
+    def __len__(self):
+        return len(self.tokens)
+    
+    def items(self):
+        return zip(self.tokens, self.counts)
+
+def _pack_counts(counts):
+    """Returns the {next_token: count} dict of a context packed, with its
+    tokens interned.
+
+    A dict takes 184 bytes even with a single key, while a context with one
+    successor packed as a flat (token, count) tuple takes 56. Most contexts
+    have only a handful of successors. Contexts with many successors go into
+    PackedCounts, whose array of 32-bit counts avoids a boxed int per count.
+    CodeNGramModel.merge_counts unpacks a context back into a dict when it
+    is seen again, and CodeNGramModel.compact packs it once more"""
+    tokens = map(sys.intern, counts)
+    if len(counts) <= _FLAT_MAX_SUCCESSORS:
+        return tuple(chain.from_iterable(zip(tokens, counts.values())))
+    try:
+        return PackedCounts(tokens, counts.values())
+    except OverflowError:
+        return counts  # a count beyond 32 bits stays in the dict
+
+def _unpack_counts(counts):
+    """Returns the {next_token: count} dict of packed context counts"""
+    if type(counts) is tuple:
+        return dict(zip(counts[::2], counts[1::2]))
+    return dict(counts.items())
+
+class NGramStore:
+    """N-gram counts and vocabulary kept in an SQLite database.
+
+    Lets CodeNGramModel train on corpora whose counts do not fit in memory.
+    The database outlives the run, so training can be resumed by passing the
+    same file again. The n-gram size is kept in the database user_version and
+    takes precedence over n, as a loaded model's does. The size and mtime of
+    the model file whose counts the store includes are kept as well, so a
+    model changed by a run without the store is not overwritten"""
+    
+    def __init__(self, path, n):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            PRAGMA synchronous = OFF;
+            CREATE TABLE IF NOT EXISTS ngrams (
+                ext TEXT NOT NULL,
+                context TEXT NOT NULL,
+                token TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (ext, context, token)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS vocab (
+                ext TEXT NOT NULL,
+                token TEXT NOT NULL,
+                PRIMARY KEY (ext, token)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS model_file (
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+        ''')
+        
+        self.n = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if self.n == 0:
+            self.adopt_n(n)
+    
+    def adopt_n(self, n):
+        """Changes the n-gram size of a store that holds no counts yet"""
+        if self.total_patterns():
+            raise ValueError(f"N-gram store holds {self.n}-grams, not {n}-grams")
+        self.connection.execute(f'PRAGMA user_version = {int(n)}')
+        self.n = n
+    
+    def record_model(self, filepath):
+        """Remembers the model file as included in the stored counts"""
+        stat = os.stat(filepath)
+        with self.connection:
+            self.connection.execute('DELETE FROM model_file')
+            self.connection.execute('INSERT INTO model_file VALUES (?, ?)', (stat.st_size, stat.st_mtime_ns))
+    
+    def includes_model(self, filepath):
+        """Whether the stored counts include the model file as it is now"""
+        stat = os.stat(filepath)
+        row = self.connection.execute('SELECT size, mtime_ns FROM model_file').fetchone()
+        return row == (stat.st_size, stat.st_mtime_ns)
+    
+    def add(self, ext, vocab, ngrams):
+        """Adds the vocabulary and {context: {next_token: count}} counts of a
+        file in a single transaction"""
+        def rows():
+            for context, counts in ngrams.items():
+                context_key = _context_key(context)
+                for token, count in counts.items():
+                    yield ext, context_key, token, count
+        
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO vocab VALUES (?, ?)',
+                ((ext, token) for token in vocab)
+            )
+            self.connection.executemany(
+                'INSERT INTO ngrams VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (ext, context, token) DO UPDATE SET count = count + excluded.count',
+                rows()
+            )
+    
+    def extensions(self):
+        return {ext for ext, in self.connection.execute('SELECT DISTINCT ext FROM vocab')}
+    
+    def total_patterns(self):
+        return self.connection.execute('SELECT COALESCE(SUM(count), 0) FROM ngrams').fetchone()[0]
+    
+    def statistics(self):
+        """Returns {ext: (patterns, unique tokens)} for every stored language"""
+        patterns = dict(self.connection.execute('SELECT ext, COUNT(*) FROM ngrams GROUP BY ext'))
+        vocab_sizes = self.connection.execute('SELECT ext, COUNT(*) FROM vocab GROUP BY ext')
+        return {ext: (patterns.get(ext, 0), vocab_size) for ext, vocab_size in vocab_sizes}
+    
+    def write_json(self, f, fields, extensions):
+        """Writes the model JSON to a text file, together with the other
+        top-level fields. The n-grams are streamed one context at a time, so
+        they are never all held in memory"""
+        dumps = partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+        execute = self.connection.execute
+        
+        f.write(dumps(fields)[:-1] + ',"vocab":{')
+        for i, ext in enumerate(extensions):
+            tokens = [token for token, in execute('SELECT token FROM vocab WHERE ext = ?', (ext,))]
+            f.write((',' if i else '') + dumps(ext) + ':' + dumps(tokens))
+        
+        f.write('},"ngrams":{')
+        for i, ext in enumerate(extensions):
+            f.write((',' if i else '') + dumps(ext) + ':{')
+            rows = execute('SELECT context, token, count FROM ngrams WHERE ext = ? ORDER BY context', (ext,))
+            for j, (context_key, group) in enumerate(groupby(rows, itemgetter(0))):
+                counts = {token: count for _, token, count in group}
+                f.write((',' if j else '') + dumps(context_key) + ':' + dumps(counts))
+            f.write('}')
+        f.write('}}')
+    
+    def close(self):
+        self.connection.close()
+
 class CodeNGramModel:
-    def __init__(self, n=4, smoothing='laplace', alpha=1.0):
+    def __init__(self, n=4, smoothing='laplace', alpha=1.0, store=None):
         self.n = n
-        self.ngrams = defaultdict(lambda: defaultdict(Counter))
+        # ext -> {context: {next_token: count}}. Only the extension level is
+        # nested: it prefixes every context, while nesting per context token
+        # would cost a dict per distinct prefix and use more memory
+        self.ngrams = {}
         self.file_extensions = set()
         self.total_patterns = 0
         self.version = "2.2"  # Обновленная версия
         self.smoothing = smoothing
         self.alpha = alpha
         self.vocab = defaultdict(set)
+        # ext -> contexts whose counts merge_counts unpacked into dicts.
+        # Only the tuples are listed, which unlike (contexts, context) pairs
+        # are not tracked by the garbage collector
+        self._loose = defaultdict(list)
+        # With an NGramStore the counts and vocabulary live in its database
+        # and self.ngrams and self.vocab stay empty
+        self.store = store
+        if store is not None:
+            self.n = store.n
+            self.file_extensions = store.extensions()
+            self.total_patterns = store.total_patterns()
     
     def train_on_file(self, filepath):
         """Trains the model on a single file, taking into account the extension"""
-        try:
-            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-            
-            ext = os.path.splitext(filepath)[1].lower()
+        result = count_file(filepath, self.n)
+        if result is not None:
+            self.merge_counts(*result)
+    
+    def merge_counts(self, ext, vocab, ngrams, total):
+        """Adds the n-gram counts of a single file returned by count_file"""
+        if self.store is not None:
+            self.store.add(ext, vocab, ngrams)
             self.file_extensions.add(ext)
-            
-            tokens = self._tokenize_code(content, ext)
-            self.vocab[ext].update(tokens)
-            sequences = self._extract_sequences(tokens, ext)
-            
-            for seq in sequences:
-                if len(seq) >= self.n:
-                    for i in range(len(seq) - self.n + 1):
-                        context = tuple(seq[i:i + self.n - 1])
-                        next_token = seq[i + self.n - 1]
-                        self.ngrams[ext][context][next_token] += 1
-                        self.total_patterns += 1
-            
-            print(f"Processed {filepath}: {len(tokens)} tokens, {len(sequences)} sequences")
-            
-        except Exception as e:
-            print(f"Error processing {filepath}: {e}")
-
-    def _tokenize_code(self, content, ext):
-        """Language-specific code tokenization"""
-        tokens = []
-        lines = content.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            if ext == '.cs':
-                line_tokens = self._tokenize_csharp(line)
-            elif ext in ['.js', '.ts']:
-                line_tokens = self._tokenize_javascript(line)
-            elif ext == '.py':
-                line_tokens = self._tokenize_python(line)
-            else:
-                line_tokens = self._tokenize_general(line)
-            
-            tokens.extend(line_tokens)
-        
-        return tokens
-    
-    def _tokenize_csharp(self, line):
-        tokens = re.findall(
-            r'public|private|protected|internal|class|interface|struct|enum|void|string|int|bool|float|double|'
-            r'var|new|using|namespace|get|set|return|if|else|for|foreach|while|switch|case|break|continue|'
-            r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}<>]|".*?"|\'.*?\'|@".*?"',
-            line
-        )
-        return [t for t in tokens if t.strip()]
-    
-    def _tokenize_javascript(self, line):
-        tokens = re.findall(
-            r'function|const|let|var|class|interface|type|export|import|from|default|return|'
-            r'if|else|for|while|switch|case|break|continue|=>|'
-            r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|".*?"|\'.*?\'|`.*?`',
-            line
-        )
-        return [t for t in tokens if t.strip()]
-    
-    def _tokenize_python(self, line):
-        tokens = re.findall(
-            r'def|class|self|import|from|as|return|if|elif|else|for|while|in|try|except|finally|with|lambda|'
-            r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|".*?"|\'.*?\'',
-            line
-        )
-        return [t for t in tokens if t.strip()]
-    
-    def _tokenize_general(self, line):
-        tokens = re.findall(
-            r'[a-zA-Z_][a-zA-Z0-9_]*|[0-9.]+|[+\-*/=<>!&|^~%]+|[:;,\.\(\)\[\]\{\}]|".*?"|\'.*?\'',
-            line
-        )
-        return [t for t in tokens if t.strip()]
-    
-    def _extract_sequences(self, tokens, ext):
-        sequences = []
-        current_sequence = []
-        
-        language_specific_enders = {
-            '.cs': [';', '{', '}'],
-            '.js': [';', '{', '}'],
-            '.ts': [';', '{', '}'],
-            '.py': [':']
-        }
+            self.total_patterns += total
+            return
         
-        enders = language_specific_enders.get(ext, [';'])
+        # Counts coming from a worker process are not interned in this one
+        intern = sys.intern
+        self.file_extensions.add(ext)
+        self.vocab[ext].update(map(intern, vocab))
         
-        for token in tokens:
-            current_sequence.append(token)
-            
-            if token in enders:
-                if current_sequence:
-                    sequences.append(current_sequence)
-                    current_sequence = []
-            elif token in {'return', 'break', 'continue', 'pass'}:
-                if current_sequence:
-                    sequences.append(current_sequence)
-                    current_sequence = []
+        ext_ngrams = self.ngrams.setdefault(ext, {})
+        loose = self._loose[ext]
+        for context, file_counts in ngrams.items():
+            counts = ext_ngrams.get(context)
+            if counts is None:
+                # New contexts are packed right away, as most are never seen again
+                ext_ngrams[tuple(map(intern, context))] = _pack_counts(file_counts)
+            else:
+                if type(counts) is not dict:
+                    counts = ext_ngrams[context] = _unpack_counts(counts)
+                    loose.append(context)
+                for token, count in file_counts.items():
+                    counts[intern(token)] = counts.get(token, 0) + count
+        self.total_patterns += total
         
-        if current_sequence:
-            sequences.append(current_sequence)
+        if len(loose) >= _COMPACT_THRESHOLD:
+            self.compact()
+    
+    def compact(self):
+        """Packs the counts merge_counts unpacked since the last call.
+
+        Done every _COMPACT_THRESHOLD contexts of a language while training,
+        so the model does not grow a dict for every context seen twice and
+        the dicts freed are reused for the next ones. A context seen again
+        within that window is only unpacked once"""
+        for ext, loose in self._loose.items():
+            contexts = self.ngrams[ext]
+            for context in loose:
+                contexts[context] = _pack_counts(contexts[context])
+        self._loose = defaultdict(list)
+    
+    def statistics(self):
+        """Returns {ext: (patterns, unique tokens)} for every trained language"""
+        if self.store is not None:
+            return self.store.statistics()
         
-        return sequences
+        statistics = {}
+        for ext in self.file_extensions:
+            # Packed counts hold a token and a count per successor
+            patterns_count = sum(
+                len(counts) // 2 if type(counts) is tuple else len(counts)
+                for counts in self.ngrams.get(ext, {}).values()
+            )
+            statistics[ext] = (patterns_count, len(self.vocab[ext]))
+        return statistics
     
     def to_serializable(self):
         """Converts the model to a serializable format"""
         serializable_ngrams = {}
         for ext, contexts in self.ngrams.items():
             serializable_ngrams[ext] = {}
-            for context, counter in contexts.items():
-                context_key = json.dumps(list(context))
-                serializable_ngrams[ext][context_key] = dict(counter)
+            for context, counts in contexts.items():
+                if type(counts) is not dict:
+                    counts = _unpack_counts(counts)
+                serializable_ngrams[ext][_context_key(context)] = counts
         
         serializable_vocab = {}
         for ext, tokens in self.vocab.items():
@@ -156,27 +407,111 @@ class CodeNGramModel:
     
     def save(self, filepath, compress=True):
         """Saves the model to a JSON file"""
-        data = self.to_serializable()
+        if self.store is not None:
+            self._save_from_store(filepath, compress)
+            return
+        
+        if compress:
+            filepath += '.gz'
+            f = gzip.open(filepath, 'wb', compresslevel=_GZIP_LEVEL)
+        else:
+            f = open(filepath, 'wb')
+        with f:
+            self._write_json(f, indent=not compress)
+        
+        print(f"Model saved to {filepath} with {self.total_patterns} patterns across {len(self.file_extensions)} languages")
+        print(f"Smoothing method: {self.smoothing}, Alpha: {self.alpha}")
+    
+    def _write_json(self, f, indent):
+        """Writes the model JSON to a binary file, indented or compact.
+
+        The n-grams are unpacked and encoded _SAVE_BATCH_SIZE contexts at a
+        time, so no second, unpacked copy of the model is built next to the
+        packed one. orjson is used when installed, otherwise json.dumps
+        encodes each batch in one shot with the C encoder"""
+        if orjson is not None:
+            dumps = partial(orjson.dumps, option=orjson.OPT_INDENT_2 if indent else 0)
+        elif indent:
+            dumps = lambda obj: json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+        else:
+            dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        newline = b'\n' if indent else b''
+        colon = b': ' if indent else b':'
+        
+        def members(obj, depth):
+            """Encodes the members of a non-empty dict, without its braces,
+            for an object nested depth levels deep"""
+            content = dumps(obj)
+            if not indent:
+                return content[1:-1]
+            padding = b'  ' * (depth - 1)
+            return padding + content[2:-2].replace(b'\n', b'\n' + padding)
+        
+        def line(depth):
+            return newline + b'  ' * depth if indent else b''
+        
+        fields = {
+            'version': self.version,
+            'n': self.n,
+            'file_extensions': list(self.file_extensions),
+            'total_patterns': self.total_patterns,
+            'smoothing': self.smoothing,
+            'alpha': self.alpha,
+            'vocab': {ext: list(tokens) for ext, tokens in self.vocab.items()}
+        }
+        f.write(b'{' + newline + members(fields, 1) + b',' + line(1) + b'"ngrams"' + colon + b'{')
+        for i, (ext, contexts) in enumerate(self.ngrams.items()):
+            f.write((b',' if i else b'') + line(2) + dumps(ext) + colon + b'{')
+            items = iter(contexts.items())
+            separator = b''
+            while True:
+                batch = {
+                    _context_key(context): counts if type(counts) is dict else _unpack_counts(counts)
+                    for context, counts in islice(items, _SAVE_BATCH_SIZE)
+                }
+                if not batch:
+                    break
+                f.write(separator + newline + members(batch, 3))
+                separator = b','
+            f.write(line(2) + b'}')
+        f.write(line(1) + b'}' + newline + b'}')
+    
+    def _save_from_store(self, filepath, compress):
+        """Saves the model with the n-grams streamed from the store. The JSON
+        is always written compact, indenting would need the whole model"""
+        fields = {
+            'version': self.version,
+            'n': self.n,
+            'file_extensions': list(self.file_extensions),
+            'total_patterns': self.total_patterns,
+            'smoothing': self.smoothing,
+            'alpha': self.alpha
+        }
         
         if compress:
             filepath += '.gz'
-            with gzip.open(filepath, 'wt', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            f = gzip.open(filepath, 'wt', encoding='utf-8', compresslevel=_GZIP_LEVEL)
         else:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            f = open(filepath, 'w', encoding='utf-8')
+        with f:
+            self.store.write_json(f, fields, sorted(self.file_extensions))
+        self.store.record_model(filepath)
         
         print(f"Model saved to {filepath} with {self.total_patterns} patterns across {len(self.file_extensions)} languages")
         print(f"Smoothing method: {self.smoothing}, Alpha: {self.alpha}")
     
     def load(self, filepath):
         """Loads the model from the JSON file"""
+        with open(filepath, 'rb') as f:
+            content = f.read()
         if filepath.endswith('.gz'):
-            with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            content = gzip.decompress(content)
+        data = orjson.loads(content) if orjson is not None else json.loads(content)
+        del content  # only the parsed model is needed from here on
+        
+        if self.store is not None and data['n'] != self.n:
+            # The model's n wins, as it does without a store
+            self.store.adopt_n(data['n'])
         
         self.version = data['version']
         self.n = data['n']
@@ -185,19 +520,61 @@ class CodeNGramModel:
         self.smoothing = data.get('smoothing', 'none')
         self.alpha = data.get('alpha', 1.0)
         
-        self.ngrams = defaultdict(lambda: defaultdict(Counter))
-        for ext, contexts in data['ngrams'].items():
-            for context_key, tokens in contexts.items():
-                context = tuple(json.loads(context_key))
-                self.ngrams[ext][context] = Counter(tokens)
+        # Context keys are JSON arrays. Without orjson the decoder's scanner
+        # parses them without the per-call overhead of json.loads
+        if orjson is not None:
+            parse_context_key = orjson.loads
+        else:
+            scan_once = json.JSONDecoder().scan_once
+            parse_context_key = lambda context_key: scan_once(context_key, 0)[0]
         
         self.vocab = defaultdict(set)
         for ext, tokens in data.get('vocab', {}).items():
             self.vocab[ext] = set(tokens)
         
+        # Each context is packed as soon as it is parsed and its parsed
+        # counts are dropped, so the parsed model and the packed one are
+        # never both held. The store takes the counts as they are
+        intern = sys.intern
+        self.ngrams = {}
+        self._loose = defaultdict(list)
+        for ext, contexts in data.pop('ngrams').items():
+            ext_ngrams = self.ngrams[ext] = {}
+            for context_key in tuple(contexts):
+                counts = contexts.pop(context_key)
+                if self.store is None:
+                    counts = _pack_counts(counts)
+                ext_ngrams[tuple(map(intern, parse_context_key(context_key)))] = counts
+        
+        if self.store is not None:
+            # Imported into the store, which holds all counts from here on
+            for ext, contexts in self.ngrams.items():
+                self.store.add(ext, self.vocab.get(ext, ()), contexts)
+            self.store.record_model(filepath)
+            self.ngrams = {}
+            self.vocab = defaultdict(set)
+        
         print(f"Model loaded from {filepath} with {self.total_patterns} patterns for {len(self.file_extensions)} languages")
         print(f"Smoothing method: {self.smoothing}, Alpha: {self.alpha}")
 
+def _throttle(items, slots, stop):
+    """Yields items while a slot is free, taking one per item.
+
+    The consumer releases a slot per result, which bounds how many items are
+    in flight. Stops as soon as stop is set"""
+    for item in items:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+def _positive_int(value):
+    """argparse type for counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Train code suggestion model with language support and smoothing')
     parser.add_argument('--model', '-m', required=True, help='Model file path')
@@ -208,57 +585,98 @@ def main():
                        default='laplace', help='Smoothing method (default: laplace)')
     parser.add_argument('--alpha', '-a', type=float, default=1.0, help='Alpha parameter for Laplace smoothing (default: 1.0)')
     parser.add_argument('--no-compress', action='store_true', help='Save without compression')
+    parser.add_argument('--jobs', '-j', type=_positive_int, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--store', help='SQLite file to accumulate n-gram counts in instead of memory')
     
     args = parser.parse_args()
     
-    patterns = []
-    if args.language:
-        language_patterns = {
-            'cs': '**/*.cs',
-            'js': '**/*.js',
-            'ts': '**/*.ts',
-            'py': '**/*.py',
-            'all': '**/*.{cs,js,ts,py}'
-        }
-        patterns.append(language_patterns[args.language])
-    
-    if args.pattern:
-        patterns.append(args.pattern)
-    
-    if not patterns:
+    if not args.language and not args.pattern:
         print("Please specify either --pattern or --language")
         return
     
-    model = CodeNGramModel(n=args.n_gram, smoothing=args.smoothing, alpha=args.alpha)
+    store = None
+    if args.store:
+        try:
+            store = NGramStore(args.store, args.n_gram)
+        except (ValueError, sqlite3.Error) as e:
+            print(f"Error opening n-gram store: {e}")
+            return
+    model = CodeNGramModel(n=args.n_gram, smoothing=args.smoothing, alpha=args.alpha, store=store)
     
     model_path = args.model
     if not model_path.endswith('.gz') and not args.no_compress:
         model_path += '.gz'
     
-    if os.path.exists(model_path) or (not args.no_compress and os.path.exists(args.model)):
+    if model.total_patterns:
+        # The store already holds the counts of the previous runs, unless the
+        # model was trained further without it
+        if os.path.exists(model_path) and not store.includes_model(model_path):
+            print(f"Model {model_path} has changed since n-gram store {args.store} last saved it, "
+                  "use a new store to keep its counts")
+            store.close()
+            return
+        print(f"Resuming from n-gram store {args.store} with {model.total_patterns} patterns")
+    elif os.path.exists(model_path) or (not args.no_compress and os.path.exists(args.model)):
         try:
             model.load(model_path)
         except Exception as e:
+            if store is not None:
+                # Saving would overwrite the model with the store's counts alone
+                print(f"Error loading model into n-gram store: {e}")
+                store.close()
+                return
             print(f"Error loading model, creating new: {e}")
     
     all_files = []
-    for pattern in patterns:
-        files = glob.glob(pattern, recursive=True)
+    if args.language:
+        language_extensions = {
+            'cs': ('.cs',),
+            'js': ('.js',),
+            'ts': ('.ts',),
+            'py': ('.py',),
+            'all': ('.cs', '.js', '.ts', '.py')
+        }
+        files = list(find_files('.', language_extensions[args.language]))
+        all_files.extend(files)
+        print(f"Found {len(files)} files for language: {args.language}")
+    
+    if args.pattern:
+        files = glob.glob(args.pattern, recursive=True)
         filtered_files = [f for f in files if 'node_modules' not in f.split(os.sep)]
         all_files.extend(filtered_files)
-        print(f"Found {len(filtered_files)} files for pattern: {pattern}")
-        
-    for i, filepath in enumerate(all_files):
-        print(f"Processing {i+1}/{len(all_files)}: {filepath}")
-        model.train_on_file(filepath)
+        print(f"Found {len(filtered_files)} files for pattern: {args.pattern}")
+    
+    # Files are counted independently in worker processes and merged here.
+    # Merging, into a store above all, can be slower than counting, and
+    # imap_unordered would then queue up every finished result in this
+    # process. Files are only handed out while few enough are in flight
+    print(f"Processing {len(all_files)} files")
+    jobs = args.jobs or os.cpu_count() or 1
+    chunksize = 16
+    slots = threading.Semaphore(2 * jobs * chunksize)
+    stop = threading.Event()
+    with multiprocessing.Pool(jobs) as pool:
+        files = _throttle(all_files, slots, stop)
+        try:
+            for result in pool.imap_unordered(partial(count_file, n=model.n), files, chunksize=chunksize):
+                slots.release()
+                if result is not None:
+                    model.merge_counts(*result)
+        finally:
+            # Unblocks the pool's task handler if the loop was cut short
+            stop.set()
+            slots.release()
+        pool.close()
+        pool.join()
     
     model.save(args.model, compress=not args.no_compress)
     
     print("\nTraining completed! Statistics by language:")
-    for ext in model.file_extensions:
-        patterns_count = sum(len(contexts) for contexts in model.ngrams[ext].values())
-        vocab_size = len(model.vocab[ext])
+    for ext, (patterns_count, vocab_size) in model.statistics().items():
         print(f"  {ext}: {patterns_count} patterns, {vocab_size} unique tokens")
+    
+    if store is not None:
+        store.close()
 
 if __name__ == "__main__":
     main()